@@ -6,8 +6,37 @@ from sklearn.pipeline import Pipeline
 from sklearn.metrics import classification_report, confusion_matrix
 from sklearn.utils.class_weight import compute_class_weight
 import xgboost as xgb
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import joblib
+import json
 import os
+import re
+import warnings
+
+ONNX_MODEL_PATH = "exoplanet.onnx"
+# Opt-in: export and serve through ONNX Runtime only with NOVATRACE_ONNX=1
+USE_ONNX = os.environ.get("NOVATRACE_ONNX") == "1"
+
+# Optional: ONNX export of the trained booster (pip install skl2onnx onnxmltools).
+# Imported only when opted in; registering the converter costs ~0.4 s.
+convert_sklearn = None
+if USE_ONNX:
+    try:
+        from skl2onnx import convert_sklearn, update_registered_converter
+        from skl2onnx.common.data_types import FloatTensorType
+        from skl2onnx.common.shape_calculator import calculate_linear_classifier_output_shapes
+        from onnxmltools.convert.xgboost.operator_converters.XGBoost import convert_xgboost
+
+        update_registered_converter(
+            xgb.XGBClassifier,
+            "XGBoostXGBClassifier",
+            calculate_linear_classifier_output_shapes,
+            convert_xgboost,
+            options={"nocl": [True, False], "zipmap": [True, False, "columns"]},
+        )
+    except ImportError:
+        convert_sklearn = None
 
 # ---------------------------------
 # Feature mapping across datasets
@@ -42,32 +71,121 @@ LABEL_NORMALIZATION = {
     "FP": "FALSE POSITIVE"
 }
 
+# ---------------------------------
+# XGBoost device selection
+# ---------------------------------
+def detect_xgb_device() -> str:
+    """Return "cuda" if XGBoost can train on a GPU here, else "cpu"."""
+    if not xgb.build_info().get("USE_CUDA", False):
+        return "cpu"
+    try:
+        # Tiny probe: without a visible GPU XGBoost warns and silently
+        # switches to CPU, so read back the device it actually used
+        probe = xgb.DMatrix(np.zeros((2, 1), dtype=np.float32), label=[0, 1])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            booster = xgb.train({"device": "cuda", "tree_method": "hist"}, probe, num_boost_round=1)
+        config = json.loads(booster.save_config())
+    except xgb.core.XGBoostError:
+        return "cpu"
+    return "cuda" if config["learner"]["generic_param"]["device"].startswith("cuda") else "cpu"
+
+XGB_DEVICE = detect_xgb_device()
+
 # ---------------------------------
 # 1. Raw dataset loading
 # ---------------------------------
-def load_raw_dataset(path: str) -> pd.DataFrame:
-    """Load CSV or Excel as-is, without feature mapping."""
-    ext = os.path.splitext(path)[1].lower()
+def _rewind(path):
+    """Seek file-like sources back to the start before a retry."""
+    if hasattr(path, "seek"):
+        path.seek(0)
+
+def _count_comment_lines(path):
+    """Count the leading '#' and blank header lines (NASA archive exports have many).
+
+    Returns None if a '#' line also appears after the header: only the C
+    engine's comment="#" drops those.
+    """
+    handle = path if hasattr(path, "readline") else open(path, "rb")
+    try:
+        count = 0
+        for line in handle:
+            stripped = line.removeprefix(b"\xef\xbb\xbf").strip()  # UTF-8 BOM
+            if stripped and not stripped.startswith(b"#"):
+                break
+            count += 1
+        if re.search(rb"\n[ \t]*#", handle.read()):
+            return None
+        return count
+    finally:
+        if handle is path:
+            _rewind(path)
+        else:
+            handle.close()
+
+def load_raw_dataset(path, ext: str = None) -> pd.DataFrame:
+    """Load CSV or Excel as-is, without feature mapping.
+
+    `path` may also be a file-like object (e.g. BytesIO), in which case
+    `ext` must be given since there is no filename to inspect.
+    """
+    if ext is None:
+        ext = os.path.splitext(path)[1].lower()
     try:
         if ext in [".xlsx", ".xls"]:
-            df = pd.read_excel(path, engine="openpyxl")
+            try:
+                df = pd.read_excel(path, engine="calamine")  # Rust reader
+            except (ImportError, ValueError):
+                _rewind(path)
+                df = pd.read_excel(path, engine="openpyxl")
         else:
             try:
+                # Arrow's multi-threaded reader has no `comment` option, so
+                # point `header` past the '#' block (pandas maps it to
+                # pyarrow's skip_rows; `skiprows` is ignored with a header)
+                header = _count_comment_lines(path)
+                if header is None:
+                    raise ValueError("'#' lines after the CSV header")
                 df = pd.read_csv(
                     path,
-                    comment="#",
-                    low_memory=False,
+                    engine="pyarrow",
+                    header=header,
                     on_bad_lines="skip",
-                    encoding="utf-8"
-                )
-            except UnicodeDecodeError:
-                df = pd.read_csv(
-                    path,
-                    comment="#",
-                    low_memory=False,
-                    on_bad_lines="skip",
-                    encoding="latin1"
+                    # Any explicit format replaces Arrow's ISO-8601 timestamp
+                    # inference, so timestamps stay text as with the C engine
+                    date_format="%Y-%m-%d"
                 )
+                # Text comes back as str dtype; only bytes and dates stay object.
+                # (select_dtypes(include=object) would also match str columns.)
+                object_columns = df.columns[df.dtypes == object]
+                # Arrow does not reject invalid UTF-8, it returns raw bytes
+                # cells; let the C engine's latin1 retry decode those files
+                if any(pd.api.types.infer_dtype(df[col], skipna=True) == "bytes" for col in object_columns):
+                    raise ValueError("CSV is not valid UTF-8")
+                # Arrow still infers pure YYYY-MM-DD columns as dates
+                for col in object_columns:
+                    if pd.api.types.infer_dtype(df[col], skipna=True) == "date":
+                        df[col] = df[col].astype(str).where(df[col].notna())
+            except Exception:
+                # Missing pyarrow, bytes cells from non-UTF-8 input, '#' lines mid-file, ...
+                _rewind(path)
+                try:
+                    df = pd.read_csv(
+                        path,
+                        comment="#",
+                        low_memory=False,
+                        on_bad_lines="skip",
+                        encoding="utf-8"
+                    )
+                except UnicodeDecodeError:
+                    _rewind(path)
+                    df = pd.read_csv(
+                        path,
+                        comment="#",
+                        low_memory=False,
+                        on_bad_lines="skip",
+                        encoding="latin1"
+                    )
     except Exception as e:
         raise ValueError(f"Failed to read dataset: {e}")
 
@@ -78,27 +196,45 @@ def load_raw_dataset(path: str) -> pd.DataFrame:
 # ---------------------------------
 # 2. Feature extraction for ML
 # ---------------------------------
-def load_features(df: pd.DataFrame, mission="kepler"):
-    """Map raw columns to ML features and extract labels if available."""
-    feature_dict = {}
+def load_features(df: pd.DataFrame, mission="kepler", dtype=np.float32):
+    """Map raw columns to ML features and extract labels if available.
+
+    Features default to float32 for training; pass dtype=np.float64 when
+    the values are echoed back to the user.
+    """
+    columns = set(df.columns)
+    mapping = {}
     for unified, options in FEATURE_MAP.items():
-        for opt in options:
-            if opt in df.columns:
-                feature_dict[unified] = df[opt]
-                break
-        if unified not in feature_dict:
-            feature_dict[unified] = pd.Series([np.nan] * len(df))
+        found = next((opt for opt in options if opt in columns), None)
+        if found is not None:
+            mapping[unified] = found
 
-    X = pd.DataFrame(feature_dict)
+    # Numeric arrays: no object upcast, float32 halves the memory of float64.
+    # Features the file lacks are added as NaN columns by reindex.
+    X = pd.DataFrame(
+        {unified: df[opt].to_numpy(dtype=dtype, na_value=np.nan) for unified, opt in mapping.items()},
+        index=df.index,
+        copy=False
+    ).reindex(columns=list(FEATURE_MAP), fill_value=dtype(np.nan))
 
     disposition_col = DISPOSITION_COLS.get(mission)
     if disposition_col and disposition_col in df.columns:
-        y = df[disposition_col].fillna("UNKNOWN")
-        y = y.map(LABEL_NORMALIZATION).fillna("UNKNOWN")  # normalize NASA/TESS/K2 labels
+        # Normalize NASA/TESS/K2 labels once per category, not once per row.
+        # Several raw labels share a target, so gather via the codes; the
+        # trailing "UNKNOWN" is what missing values (code -1) pick up.
+        y = df[disposition_col].astype("category")
+        normalized = y.cat.categories.map(LABEL_NORMALIZATION).fillna("UNKNOWN")
+        lookup = np.append(normalized.to_numpy(dtype=object), "UNKNOWN")
+        y = pd.Series(lookup[y.cat.codes.to_numpy()], index=df.index, name=disposition_col)
         return X, y
     else:
         return X, None
 
+def infer_mission(df: pd.DataFrame):
+    """Name the mission whose disposition column the file has, else None."""
+    columns = set(df.columns)
+    return next((mission for mission, col in DISPOSITION_COLS.items() if col in columns), None)
+
 # ---------------------------------
 # 3. Build ML pipeline
 # ---------------------------------
@@ -111,7 +247,10 @@ def build_model():
         learning_rate=0.05,
         subsample=0.8,
         colsample_bytree=0.8,
-        tree_method="hist"
+        tree_method="hist",
+        device=XGB_DEVICE,  # GPU histogram backend when available, CPU hist otherwise
+        early_stopping_rounds=25,  # needs an eval_set at fit time
+        n_jobs=os.cpu_count()
     )
 
     pipeline = Pipeline([
@@ -123,39 +262,115 @@ def build_model():
 # ---------------------------------
 # 4. Unified training across missions
 # ---------------------------------
-def train_unified(datasets):
-    X_all, y_all = [], []
-    for path, mission in datasets:
-        df = load_raw_dataset(path)
-        X, y = load_features(df, mission)
-        if y is not None:
-            # Fill only numeric columns with median
-            X_numeric = X.select_dtypes(include=[np.number])
-            X[X_numeric.columns] = X_numeric.fillna(X_numeric.median())
-            X_all.append(X)
-            y_all.append(y)
-
-    X_full = pd.concat(X_all, ignore_index=True)
-    y_full = pd.concat(y_all, ignore_index=True)
+TRAIN_CACHE_PATH = "train_cache.parquet"
+TRAIN_CACHE_META_PATH = "train_cache.json"
+# Bump when the cached matrix or its metadata changes format or meaning
+TRAIN_CACHE_VERSION = 3
+
+def _datasets_signature(datasets):
+    """Cache format, feature/label config and source files (paths, missions,
+    mtimes) identifying a training matrix. Kept JSON-shaped so it compares
+    equal after a round-trip through the metadata file."""
+    return {
+        "version": TRAIN_CACHE_VERSION,
+        "features": FEATURE_MAP,
+        "labels": LABEL_NORMALIZATION,
+        "dispositions": DISPOSITION_COLS,
+        "sources": [[path, mission, os.path.getmtime(path)] for path, mission in datasets],
+    }
+
+def _load_training_cache(datasets):
+    """Return cached (X_full, y_full, medians) if the source files are unchanged, else None."""
+    if not (os.path.exists(TRAIN_CACHE_PATH) and os.path.exists(TRAIN_CACHE_META_PATH)):
+        return None
+    with open(TRAIN_CACHE_META_PATH) as f:
+        meta = json.load(f)
+    # Caches from older formats lack the signature and are rebuilt
+    if meta.get("signature") != _datasets_signature(datasets) or "medians" not in meta:
+        return None
+    cached = pd.read_parquet(TRAIN_CACHE_PATH)
+    y_full = cached.pop("label").to_numpy(dtype=object)
+    return cached.to_numpy(dtype=np.float32), y_full, meta["medians"]
+
+def _save_training_cache(datasets, X_full, y_full, medians):
+    cached = pd.DataFrame(X_full, columns=list(FEATURE_MAP))
+    cached["label"] = y_full
+    cached.to_parquet(TRAIN_CACHE_PATH, index=False)
+    with open(TRAIN_CACHE_META_PATH, "w") as f:
+        json.dump({"signature": _datasets_signature(datasets), "medians": medians}, f)
+
+def _load_training_data(datasets):
+    """Parse every mission file into one labelled feature matrix.
+
+    Also returns the per-mission medians used to fill missing features,
+    so uploads can be imputed the same way.
+    """
+    X_all, y_all, medians = [], [], {}
+    # Parse the files concurrently (the CSV parsers release the GIL);
+    # feature extraction stays on this thread, in dataset order
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        frames = executor.map(load_raw_dataset, [path for path, _ in datasets])
+        for (path, mission), df in zip(datasets, frames):
+            # float64 until imputed, so the saved medians are the exact
+            # values uploads are echoed with; the matrix itself is float32
+            X, y = load_features(df, mission, dtype=np.float64)
+            if y is not None:
+                # Fill only numeric columns with median
+                X_numeric = X.select_dtypes(include=[np.number])
+                mission_medians = X_numeric.median()
+                X[X_numeric.columns] = X_numeric.fillna(mission_medians)
+                medians[mission] = {k: float(v) for k, v in mission_medians.items()}
+                X_all.append(X.to_numpy(dtype=np.float32))
+                y_all.append(y.to_numpy())
+
+    # Plain ndarray concat: skips pandas' block-manager reconciliation
+    X_full = np.concatenate(X_all, axis=0)
+    y_full = np.concatenate(y_all)
 
     # Filter out UNKNOWN before encoding
     mask = y_full != "UNKNOWN"
-    X_full = X_full[mask]
-    y_full = y_full[mask]
+    return X_full[mask], y_full[mask], medians
+
+def train_unified(datasets):
+    # Re-parsing the CSVs dominates /retrain; reuse the Parquet copy
+    # of the matrix while the source files are unchanged
+    cached = _load_training_cache(datasets)
+    if cached is not None:
+        X_full, y_full, medians = cached
+    else:
+        X_full, y_full, medians = _load_training_data(datasets)
+        _save_training_cache(datasets, X_full, y_full, medians)
 
     le = LabelEncoder()
-    y_encoded = le.fit_transform(y_full)
+    # Three classes: uint8 labels beside the float32 matrix keep memory low
+    y_encoded = le.fit_transform(y_full).astype(np.uint8)
 
     X_train, X_test, y_train, y_test = train_test_split(
         X_full, y_encoded, test_size=0.2, stratify=y_encoded, random_state=42
     )
 
-    classes = np.unique(y_train)
-    weights = compute_class_weight("balanced", classes=classes, y=y_train)
-    sample_weights = np.array([weights[label] for label in y_train])
+    # Hold out 10% of the training split to drive early stopping
+    X_fit, X_val, y_fit, y_val = train_test_split(
+        X_train, y_train, test_size=0.1, stratify=y_train, random_state=42
+    )
+
+    classes = np.unique(y_fit)
+    weights = compute_class_weight("balanced", classes=classes, y=y_fit)
+    # Labels are 0..K-1 and `classes` is sorted, so a gather maps label -> weight
+    sample_weights = weights[y_fit]
 
     pipeline = build_model()
-    pipeline.fit(X_train, y_train, model__sample_weight=sample_weights)
+    # eval_set bypasses the pipeline's scaler, so scale it with the same
+    # fit that pipeline.fit will reproduce on X_fit
+    X_val_scaled = pipeline.named_steps["scaler"].fit(X_fit).transform(X_val)
+    # X_full is float32: halves host->device transfer, XGBoost's native input type
+    pipeline.fit(
+        X_fit, y_fit,
+        model__sample_weight=sample_weights,
+        model__eval_set=[(X_val_scaled, y_val)],
+        model__sample_weight_eval_set=[weights[y_val]],
+        model__verbose=False
+    )
 
     # Evaluate (only on true scientific labels)
     y_pred = pipeline.predict(X_test)
@@ -164,15 +379,10 @@ def train_unified(datasets):
     # --- Custom prediction function with UNKNOWN threshold ---
     def predict_with_unknown(pipeline, encoder, X, threshold=0.6):
         probs = pipeline.predict_proba(X)
-        preds = []
-        for p in probs:
-            max_idx = np.argmax(p)
-            max_prob = p[max_idx]
-            if max_prob < threshold:
-                preds.append("UNKNOWN")
-            else:
-                preds.append(encoder.classes_[max_idx])
-        return preds, probs
+        best_idx = probs.argmax(axis=1)
+        best_conf = probs.max(axis=1)
+        preds = np.where(best_conf >= threshold, encoder.classes_[best_idx], "UNKNOWN")
+        return preds.tolist(), probs
 
     # Example usage
     sample_pred, sample_probs = predict_with_unknown(pipeline, le, X_test[:5])
@@ -181,28 +391,61 @@ def train_unified(datasets):
     print("=== Confusion Matrix ===")
     print(confusion_matrix(y_test, y_pred))
 
-    # Save model and encoder
+    # Save model, encoder and per-mission training medians (used to impute uploads)
     joblib.dump(pipeline, "exoplanet_model.pkl")
     joblib.dump(le, "label_encoder.pkl")
+    joblib.dump({"medians": medians}, "impute_medians.pkl")
+
+    # Any existing ONNX file would be stale for the model just trained
+    if os.path.exists(ONNX_MODEL_PATH):
+        os.remove(ONNX_MODEL_PATH)
+    if USE_ONNX and convert_sklearn is not None:
+        try:
+            export_onnx(pipeline)
+        except Exception as e:
+            # The model files are already saved; serve them via XGBoost
+            print(f"ONNX export failed, keeping XGBoost inference: {e}")
 
     return pipeline, le
 
 # ---------------------------------
-# 5. Helper for predictions with thresholds
+# 5. ONNX export for onnxruntime inference
+# ---------------------------------
+def export_onnx(pipeline, path=ONNX_MODEL_PATH):
+    """Export the XGBoost step (up to its best iteration) to ONNX.
+
+    Only the classifier is converted; callers scale inputs with the fitted
+    StandardScaler first. ONNX's Scaler op rounds differently from sklearn,
+    enough to flip samples that sit exactly on a split threshold.
+    """
+    model = pipeline.named_steps["model"]
+    onnx_model = convert_sklearn(
+        model,
+        initial_types=[("input", FloatTensorType([None, len(FEATURE_MAP)]))],
+        options={id(model): {"zipmap": False}},  # probabilities as a plain tensor
+        target_opset={"": 17, "ai.onnx.ml": 3},
+    )
+    # The ONNX file is only valid beside this pipeline's scaler; record
+    # which trees it holds so the server can detect a stale file
+    fingerprint = onnx_model.metadata_props.add()
+    fingerprint.key, fingerprint.value = "model_sha256", model_fingerprint(pipeline)
+    with open(path, "wb") as f:
+        f.write(onnx_model.SerializeToString())
+
+def model_fingerprint(pipeline):
+    """SHA-256 of the pipeline's trees, identifying the training run they came from."""
+    return hashlib.sha256(pipeline.named_steps["model"].get_booster().save_raw("ubj")).hexdigest()
+
+# ---------------------------------
+# 6. Helper for predictions with thresholds
 # ---------------------------------
 def classify_with_confidence(model, encoder, X, threshold=0.6):
     """Return class + confidence, only accept if prob >= threshold else 'UNKNOWN'."""
     probs = model.predict_proba(X)
     best_idx = probs.argmax(axis=1)
     best_conf = probs.max(axis=1)
-
-    preds = []
-    for idx, conf in zip(best_idx, best_conf):
-        if conf >= threshold:
-            preds.append((encoder.inverse_transform([idx])[0], float(conf)))
-        else:
-            preds.append(("UNKNOWN", float(conf)))
-    return preds
+    labels = np.where(best_conf >= threshold, encoder.classes_[best_idx], "UNKNOWN")
+    return list(zip(labels.tolist(), best_conf.tolist()))
 
 # ---------------------------------
 # Example Usage
@@ -4,15 +4,24 @@ from fastapi.responses import JSONResponse
 import pandas as pd
 import numpy as np
 import joblib
+import orjson
 import tempfile
 import shutil
 import os
-from exoplanet_pipeline import load_raw_dataset, load_features, train_unified, build_model
+from io import BytesIO
+from exoplanet_pipeline import load_raw_dataset, load_features, infer_mission, train_unified, build_model, XGB_DEVICE, FEATURE_MAP, ONNX_MODEL_PATH, USE_ONNX, model_fingerprint
 from pydantic import BaseModel
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 import xgboost as xgb
 
+ort = None
+if USE_ONNX:
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        pass
+
 
 app = FastAPI()
 
@@ -28,43 +37,85 @@ app.add_middleware(
 # Load saved model + encoder
 model = joblib.load("exoplanet_model.pkl")
 encoder = joblib.load("label_encoder.pkl")
+# Upper-cased class names, indexed by encoded label
+CLASSES_UPPER = np.char.upper(encoder.classes_.astype(str))
+
+# Raw booster for inplace_predict; unlike XGBClassifier.predict_proba it
+# does not stop at the early-stopping best iteration on its own.
+# Taken from the pickle so it always matches the pipeline's scaler.
+booster = model.named_steps["model"].get_booster()
+_best_iteration = booster.attr("best_iteration")
+BEST_ITERATION_RANGE = (0, int(_best_iteration) + 1) if _best_iteration is not None else (0, 0)
+
+# Optional onnxruntime session, opt-in via NOVATRACE_ONNX=1 once training
+# has exported an ONNX model
+if USE_ONNX and ort is not None and os.path.exists(ONNX_MODEL_PATH):
+    _session_options = ort.SessionOptions()
+    _session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    onnx_session = ort.InferenceSession(
+        ONNX_MODEL_PATH, _session_options, providers=ort.get_available_providers()
+    )
+    # exoplanet.onnx is untracked: after pulling a new model it may hold
+    # trees from another run than the pickle's scaler
+    if onnx_session.get_modelmeta().custom_metadata_map.get("model_sha256") != model_fingerprint(model):
+        print(f"{ONNX_MODEL_PATH} does not match exoplanet_model.pkl, using XGBoost inference")
+        onnx_session = None
+else:
+    onnx_session = None
+
+# Per-mission training medians for imputation, in FEATURE_MAP order
+# (missing for models trained before they were saved)
+if os.path.exists("impute_medians.pkl"):
+    IMPUTE_MEDIANS = {
+        name: pd.Series(medians, dtype=np.float64).reindex(list(FEATURE_MAP))
+        for name, medians in joblib.load("impute_medians.pkl")["medians"].items()
+    }
+else:
+    IMPUTE_MEDIANS = {}
 
 
 # -------------------------------
-# Helper: Make DataFrame JSON-safe
+# Helper: orjson-rendered responses
 # -------------------------------
-def make_json_safe(df: pd.DataFrame):
+def _json_default(value):
+    """orjson fallback for the pandas scalars it cannot encode natively."""
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="ignore")
+    if isinstance(value, pd.Timestamp):
+        return str(value)  # e.g. date cells in Excel uploads
+    raise TypeError
+
+
+def _stringify_big_ints(value):
+    """Replace ints beyond 64 bits, which orjson rejects, with their digits."""
+    if isinstance(value, dict):
+        return {key: _stringify_big_ints(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_stringify_big_ints(item) for item in value]
+    if isinstance(value, int) and not -2**63 <= value < 2**64:
+        return str(value)
+    return value
+
+
+class NumpyJSONResponse(JSONResponse):
     """
-    Convert DataFrame to fully JSON-safe format:
-    - Replace NaN / inf / -inf with None
-    - Convert numpy numeric types to native Python float/int
-    - Convert bytes → str
+    JSONResponse rendered with orjson, so DataFrame records need no cleanup:
+    - NaN / inf / -inf → null
+    - numpy numeric types serialized natively
+    - bytes → str, timestamps → str, pd.NA / NaT → null
+    - ints beyond 64 bits → str
     """
-    df_safe = df.copy()
-
-    # Replace infinities with NaN
-    df_safe = df_safe.mask(df_safe.isin([np.inf, -np.inf]))
-
-    # Convert DataFrame to list of dicts
-    records = df_safe.to_dict(orient="records")
-
-    safe_records = []
-    for row in records:
-        safe_row = {}
-        for k, v in row.items():
-            if pd.isna(v):  # catches np.nan, None, NaT
-                safe_row[k] = None
-            elif isinstance(v, (np.integer, np.int64)):
-                safe_row[k] = int(v)
-            elif isinstance(v, (np.floating, np.float64)):
-                safe_row[k] = float(v)
-            elif isinstance(v, (bytes, bytearray)):
-                safe_row[k] = v.decode("utf-8", errors="ignore")
-            else:
-                safe_row[k] = v
-        safe_records.append(safe_row)
 
-    return safe_records
+    def render(self, content) -> bytes:
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        try:
+            return orjson.dumps(content, default=_json_default, option=options)
+        except orjson.JSONEncodeError:
+            # orjson raises on oversized ints without consulting `default`;
+            # e.g. koi_quarters bit strings when the C engine parses a CSV
+            return orjson.dumps(_stringify_big_ints(content), default=_json_default, option=options)
 
 
 # -------------------------------
@@ -73,59 +124,89 @@ def make_json_safe(df: pd.DataFrame):
 @app.post("/upload")
 async def upload(
     file: UploadFile = File(...),
-    mission: str = Query("kepler"),
-    preview: bool = Query(True)
+    mission: str | None = Query(None),
+    preview: bool = Query(True),
+    preview_rows: int | None = Query(None, ge=1)
 ):
-    # Save uploaded file temporarily
     suffix = os.path.splitext(file.filename)[1].lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        file.file.seek(0)
-        shutil.copyfileobj(file.file, tmp)
-        tmp_path = tmp.name
 
-    try:
-        df = load_raw_dataset(tmp_path)
-    except Exception as e:
-        os.remove(tmp_path)
-        return JSONResponse({"error": f"Failed to read file: {e}"}, status_code=400)
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+    if suffix in [".xlsx", ".xls"]:
+        # Excel readers want a real file: stream to disk with a 4 MB buffer
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+            file.file.seek(0)
+            shutil.copyfileobj(file.file, tmp, length=4 * 1024 * 1024)
+            tmp_path = tmp.name
+
+        try:
+            df = load_raw_dataset(tmp_path)
+        except Exception as e:
+            return JSONResponse({"error": f"Failed to read file: {e}"}, status_code=400)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        # CSV: parse straight from memory, no write + re-read round-trip
+        await file.seek(0)
+        contents = await file.read()
+        try:
+            df = load_raw_dataset(BytesIO(contents), ext=suffix)
+        except Exception as e:
+            return JSONResponse({"error": f"Failed to read file: {e}"}, status_code=400)
 
     # -------------------------------
     # Preview branch
     # -------------------------------
     if preview:
-        df_preview = df.dropna(how="all").dropna(axis=1, how="all")
-        rows_safe = make_json_safe(df_preview)
-        return JSONResponse(
-            {"columns": df_preview.columns.tolist(), "rows": rows_safe},
+        # Drop empty rows/columns. The preview table searches, sorts and
+        # counts all rows client-side, so only cap them when asked to
+        present = df.notna()
+        rows = df.index[present.any(axis=1)][:preview_rows]
+        df_preview = df.loc[rows, present.any(axis=0)]
+        return NumpyJSONResponse(
+            {"columns": df_preview.columns.tolist(), "rows": df_preview.to_dict(orient="records")},
             status_code=200
         )
 
     # -------------------------------
     # ML prediction branch
     # -------------------------------
-    X, _ = load_features(df, mission)
+    # float64 so the results echo the uploaded values; the model input is
+    # cast to float32 below
+    X, _ = load_features(df, mission, dtype=np.float64)
+    # The frontend sends no mission: recognise the NASA exports by their
+    # disposition column rather than imputing everything as Kepler
+    if mission is None:
+        mission = infer_mission(df)
     print("Columns passed to model:", X.columns.tolist())
     print("First row features:\n", X.iloc[0])
 
-    # Fill numeric NaNs with median
-    X_numeric = X.select_dtypes(include=[np.number])
-    X[X_numeric.columns] = X_numeric.fillna(X_numeric.median())
-
-    # Predictions + probabilities
-    preds = model.predict(X)
-    probs = model.predict_proba(X)  # shape (n_samples, n_classes)
-    preds_decoded = encoder.inverse_transform(preds)
+    # Fill NaNs with the mission's training medians, else (mission unknown)
+    # fall back to this file's medians. Features the mission never reports have a NaN median
+    # and stay missing, as they did in training.
+    if mission in IMPUTE_MEDIANS:
+        X = X.fillna(IMPUTE_MEDIANS[mission])
+    else:
+        # Only take medians of features the file reports; all-NaN ones
+        # (e.g. snr outside KOI) stay missing, which XGBoost handles natively
+        X_numeric = X.select_dtypes(include=[np.number])
+        reported = X_numeric.columns[X_numeric.notna().any(axis=0)]
+        X[reported] = X_numeric[reported].fillna(X_numeric[reported].median())
+
+    # Predictions + probabilities: one scaler pass and one booster pass.
+    # to_numpy copies, so scaling in place leaves X intact for the results.
+    X_scaled = model.named_steps["scaler"].transform(
+        X.to_numpy(dtype=np.float32, copy=True), copy=False
+    )
+    if onnx_session is not None:
+        probs = onnx_session.run(None, {"input": X_scaled})[1]  # outputs: label, probabilities
+    else:
+        probs = booster.inplace_predict(X_scaled, iteration_range=BEST_ITERATION_RANGE)  # shape (n_samples, n_classes)
+    preds = probs.argmax(axis=1)
     print("Label encoder classes:", encoder.classes_)
 
 
     # Confidence = probability of predicted class
-    confidences = []
-    for i, pred_class in enumerate(preds):
-        conf = float(probs[i, pred_class])  # safe Python float
-        confidences.append(conf)
+    confidences = probs[np.arange(len(preds)), preds].tolist()  # Python floats
 
     # Combine results
     results = X.copy()
@@ -135,17 +216,13 @@ async def upload(
         if id_col in df.columns and id_col not in results.columns:
             results[id_col] = df[id_col]
 
-    results["Predicted_Disposition"] = [d.upper() for d in preds_decoded]
+    results["Predicted_Disposition"] = CLASSES_UPPER[preds]
     print('results :', results.shape)
     print('results :', results.columns)
     results["Confidence"] = confidences
 
-    # Make results JSON-safe
-    rows_safe = make_json_safe(results)
-
-
-    return JSONResponse(
-        {"columns": results.columns.tolist(), "rows": rows_safe},
+    return NumpyJSONResponse(
+        {"columns": results.columns.tolist(), "rows": results.to_dict(orient="records")},
         status_code=200
     )
 
@@ -184,7 +261,10 @@ async def retrain(params: RetrainRequest):
                 learning_rate=learning_rate,
                 subsample=0.8,
                 colsample_bytree=0.8,
-                tree_method="hist"
+                tree_method="hist",
+                device=XGB_DEVICE,
+                early_stopping_rounds=25,
+                n_jobs=os.cpu_count()
             )
             return Pipeline([("scaler", StandardScaler()), ("model", model)])
 
@@ -0,0 +1,27 @@
+"""Regression checks for the upload path. Run from backend/: python -m unittest"""
+import unittest
+from io import BytesIO
+
+import orjson
+
+from exoplanet_pipeline import load_raw_dataset
+from server import NumpyJSONResponse
+
+
+class OversizedIntTest(unittest.TestCase):
+    def test_c_engine_koi_quarters_render(self):
+        # One latin1 byte sends the file through the C engine, which parses
+        # koi_quarters bit strings as Python ints beyond 64 bits
+        csv = "# comment\nkepoi_name,koi_quarters\nK00752.01 \xe9,11111111111111111000000000000000\n"
+        df = load_raw_dataset(BytesIO(csv.encode("latin1")), ext=".csv")
+
+        body = NumpyJSONResponse({"rows": df.to_dict(orient="records")}).body
+
+        self.assertEqual(
+            orjson.loads(body)["rows"],
+            [{"kepoi_name": "K00752.01 é", "koi_quarters": "11111111111111111000000000000000"}],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()